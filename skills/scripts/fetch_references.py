@@ -13,25 +13,300 @@ Supported styles: vancouver (default), apa, nature
 Supported output formats: json (default), bibtex
 """
 
+import aiohttp
 import argparse
+import asyncio
+import collections
+import hashlib
 import json
+import os
 import re
-import requests
 import sys
+import tempfile
+import textwrap
 import time
 
+try:
+    import orjson
+except ImportError:  # optional speedup; the stdlib json module is the fallback
+    orjson = None
+
+DEFAULT_CACHE_DIR = os.path.join("~", ".cache", "academic-manuscript-skill", "crossref")
+DEFAULT_CACHE_TTL_DAYS = 90
+
+# Set once a cache write fails, so the warning is printed only once per run
+cache_warned = False
+
+# Transient CrossRef responses worth retrying, with exponential backoff
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+
+# First character of each whitespace-separated given name, same as split()[i][0]
+INITIAL_RE = re.compile(r"(?:^|\s)(\S)")
+
+# CrossRef accepts up to this many doi: filters per /works query
+BATCH_SIZE = 50
+
+
+def json_loads(raw):
+    """Decode JSON from bytes or str, using orjson when available."""
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+
+def json_dumps(obj, indent=False):
+    """Encode JSON to a str (UTF-8, not ASCII-escaped), using orjson when available."""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0).decode("utf-8")
+    if indent:
+        return json.dumps(obj, indent=2, ensure_ascii=False)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def cache_path(cache_dir, doi):
+    """Return the on-disk cache file path for a DOI."""
+    key = hashlib.sha1(doi.lower().encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, key[:2], f"{key}.json")
+
+
+def read_cache(path):
+    """Load a cached JSON payload, returning None if missing or unreadable."""
+    try:
+        with open(path, "rb") as f:
+            return json_loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache(path, payload):
+    """Atomically write a JSON payload to the cache."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), suffix=".tmp",
+                                     delete=False, encoding="utf-8") as f:
+        f.write(json_dumps(payload))
+    try:
+        os.replace(f.name, path)
+    except OSError:
+        os.remove(f.name)
+        raise
+
+
+def warn_cache_error(e):
+    """Report an unusable cache once per run; fetching carries on without it."""
+    global cache_warned
+    if not cache_warned:
+        print(f"  Warning: could not update CrossRef cache: {e}", file=sys.stderr)
+        cache_warned = True
+
+
+def store_cache(path, payload):
+    """Best-effort write_cache: a cache failure never loses fetched data."""
+    try:
+        write_cache(path, payload)
+    except OSError as e:
+        warn_cache_error(e)
+
+
+def touch_cache(path):
+    """Best-effort mtime refresh for a revalidated cache entry."""
+    try:
+        os.utime(path)
+    except OSError as e:
+        warn_cache_error(e)
+
+
+def retry_delay(attempt, retry_after=None):
+    """Seconds to wait before retry `attempt`, honoring a Retry-After header."""
+    if retry_after:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            pass
+    return BACKOFF_FACTOR * (2 ** attempt)
+
+
+async def crossref_get(session, url, headers=None, params=None, timeout=15):
+    """GET a CrossRef URL, retrying transient failures.
+
+    Returns ``(status, headers, body)`` where ``body`` is the decoded JSON for
+    a 200 response and None otherwise. Re-raises the last connection error.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with session.get(url, headers=headers, params=params,
+                                   timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+                if r.status in RETRY_STATUSES and attempt < MAX_RETRIES:
+                    wait = retry_delay(attempt, r.headers.get("Retry-After"))
+                else:
+                    body = json_loads(await r.read()) if r.status == 200 else None
+                    return r.status, r.headers, body
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt >= MAX_RETRIES:
+                raise
+            wait = retry_delay(attempt)
+        # Back off only after the response is released, so the pooled
+        # connection is free for other requests in the meantime
+        await asyncio.sleep(wait)
+
+
+async def fetch_crossref(session, doi, cache_dir=None, cache_ttl=0):
+    """Fetch metadata from CrossRef API for a given DOI.
+
+    Returns a ``(data, from_cache)`` tuple. Successful lookups and 404s are
+    cached under ``cache_dir`` and reused for ``cache_ttl`` seconds; expired
+    entries are revalidated with a conditional GET, and returned as-is if
+    revalidation fails.
+    """
+    path = cache_path(cache_dir, doi) if cache_dir else None
+    meta_path = path[:-len(".json")] + ".meta.json" if path else None
+    cached = read_cache(path) if path and os.path.exists(path) else None
+
+    if cached is not None and time.time() - os.path.getmtime(path) < cache_ttl:
+        return (None if cached.get("_notfound") else cached), True
 
-def fetch_crossref(doi, email="user@example.com"):
-    """Fetch metadata from CrossRef API for a given DOI."""
     url = f"https://api.crossref.org/works/{doi}"
-    headers = {"User-Agent": f"AcademicManuscriptSkill/1.0 (mailto:{email})"}
+    headers = {}
+    stale = cached if cached is not None and not cached.get("_notfound") else None
+    if stale is not None:
+        meta = read_cache(meta_path) or {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
     try:
-        r = requests.get(url, headers=headers, timeout=15)
-        if r.status_code == 200:
-            return r.json()["message"]
+        status, resp_headers, body = await crossref_get(session, url, headers=headers)
+        data = body["message"] if status == 200 else None
     except Exception as e:
         print(f"  Error for {doi}: {e}", file=sys.stderr)
-    return None
+        # Revalidation failed; expired metadata beats falling back to plain text
+        return stale, False
+
+    # Cache updates happen outside the network try so a failed write
+    # can never discard a record CrossRef just returned
+    if status == 304 and headers:
+        touch_cache(path)
+        return cached, False
+    if status == 200:
+        if path:
+            store_cache(path, data)
+            meta = {
+                "etag": resp_headers.get("ETag"),
+                "last_modified": resp_headers.get("Last-Modified"),
+            }
+            if meta["etag"] or meta["last_modified"]:
+                store_cache(meta_path, meta)
+            elif os.path.exists(meta_path):
+                # Old validators no longer describe this record
+                try:
+                    os.remove(meta_path)
+                except OSError as e:
+                    warn_cache_error(e)
+        return data, False
+    if status == 404:
+        if path:
+            # Remember dead DOIs so they are not retried on every run
+            store_cache(path, {"_notfound": True})
+        return None, False
+    return stale, False
+
+
+async def fetch_crossref_batch(session, dois, email, cache_dir=None, sem=None, delay=0):
+    """Fetch many DOIs through the /works?filter=doi:... endpoint.
+
+    DOIs are sent in chunks of up to BATCH_SIZE per request; chunks run
+    concurrently under `sem` with the same polite `delay` as single fetches.
+    Returns a ``{doi_lower: message_item}`` dict; DOIs missing from it should
+    be fetched individually.
+    """
+    sem = sem or asyncio.Semaphore(1)
+
+    async def fetch_chunk(chunk):
+        params = {
+            "filter": ",".join(f"doi:{d}" for d in chunk),
+            "rows": len(chunk),
+            "mailto": email,
+        }
+        async with sem:
+            try:
+                status, _, body = await crossref_get(session, "https://api.crossref.org/works",
+                                                     params=params, timeout=30)
+            except Exception as e:
+                print(f"  Batch error for {len(chunk)} DOIs: {e}", file=sys.stderr)
+                return []
+            finally:
+                await asyncio.sleep(delay)
+        return body["message"].get("items", []) if status == 200 else []
+
+    chunks = [dois[i:i + BATCH_SIZE] for i in range(0, len(dois), BATCH_SIZE)]
+    found = {}
+    for items in await asyncio.gather(*(fetch_chunk(chunk) for chunk in chunks)):
+        for item in items:
+            doi = item.get("DOI", "").lower()
+            found[doi] = item
+            if cache_dir:
+                store_cache(cache_path(cache_dir, doi), item)
+    return found
+
+
+def needs_batch(doi, cache_dir, cache_ttl):
+    """True if a DOI should go through the batch endpoint rather than a single GET.
+
+    That is every DOI with no cache entry, plus expired entries whose sidecar
+    holds no ETag or Last-Modified (including ones that came from a batch and
+    have no sidecar at all), since a per-DOI GET for those could not be
+    conditional anyway.
+    """
+    if "," in doi:
+        # Commas would split the filter expression, so those DOIs go one at a time
+        return False
+    if not cache_dir:
+        return True
+    path = cache_path(cache_dir, doi)
+    if not os.path.exists(path):
+        return True
+    if time.time() - os.path.getmtime(path) < cache_ttl:
+        return False
+    meta = read_cache(path[:-len(".json")] + ".meta.json") or {}
+    return not (meta.get("etag") or meta.get("last_modified"))
+
+
+async def fetch_all(refs_input, email, delay, concurrency=8, cache_dir=None, cache_ttl=0):
+    """Fetch CrossRef metadata for all refs concurrently, preserving input order.
+
+    DOIs that need a full fetch are batched first (see needs_batch); anything
+    the batch misses, plus expired entries that can be revalidated, goes
+    through per-DOI requests.
+    """
+    headers = {"User-Agent": f"AcademicManuscriptSkill/1.0 (mailto:{email})"}
+    sem = asyncio.Semaphore(concurrency)
+    # One pooled keep-alive connector so every DOI reuses the same TLS connections
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency)
+
+    to_batch = list(dict.fromkeys(
+        ref["doi"].lower() for ref in refs_input
+        if ref.get("doi") and needs_batch(ref["doi"], cache_dir, cache_ttl)
+    ))
+
+    async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+        batched = {}
+        if to_batch:
+            batched = await fetch_crossref_batch(session, to_batch, email, cache_dir, sem, delay)
+
+        async def bounded(ref):
+            doi = ref.get("doi")
+            if not doi:
+                return None
+            if doi.lower() in batched:
+                return batched[doi.lower()]
+            async with sem:
+                data, from_cache = await fetch_crossref(session, doi, cache_dir, cache_ttl)
+                # Keep the polite-pool pacing per connection slot
+                if not from_cache:
+                    await asyncio.sleep(delay)
+                return data
+
+        return await asyncio.gather(*(bounded(ref) for ref in refs_input))
 
 
 def format_authors(authors_list, style="vancouver", max_authors=6):
@@ -44,14 +319,15 @@ def format_authors(authors_list, style="vancouver", max_authors=6):
         family = a.get("family", "")
         given = a.get("given", "")
 
+        letters = INITIAL_RE.findall(given) if given else []
         if style == "vancouver":
-            initials = ". ".join([p[0] for p in given.split() if p]) + "." if given else ""
+            initials = ". ".join(letters) + "." if given else ""
             formatted.append(f"{family} {initials}".strip())
         elif style == "apa":
-            initials = " ".join([f"{p[0]}." for p in given.split() if p]) if given else ""
+            initials = " ".join(m + "." for m in letters)
             formatted.append(f"{family}, {initials}".strip())
         elif style == "nature":
-            initials = " ".join([f"{p[0]}." for p in given.split() if p]) if given else ""
+            initials = " ".join(m + "." for m in letters)
             formatted.append(f"{family}, {initials}".strip())
 
     if style == "apa" and len(formatted) > 1:
@@ -78,16 +354,31 @@ def extract_year(data):
     return str(issued[0]) if issued and issued[0] else ""
 
 
-def format_vancouver(data):
+RefFields = collections.namedtuple(
+    "RefFields", ["authors", "title", "journal", "year", "volume", "issue", "pages", "doi"]
+)
+
+
+def extract_fields(data):
+    """Pull the fields every formatter needs out of CrossRef data in one pass."""
+    return RefFields(
+        authors=data.get("author", []),
+        title=data.get("title", [""])[0],
+        journal=extract_journal(data),
+        year=extract_year(data),
+        volume=data.get("volume", ""),
+        issue=data.get("issue", ""),
+        pages=data.get("page", ""),
+        doi=data.get("DOI", ""),
+    )
+
+
+def format_vancouver(data, fields=None):
     """Format reference in Vancouver/NLM style."""
-    authors = format_authors(data.get("author", []), "vancouver")
-    title = data.get("title", [""])[0].rstrip(".")
-    journal = extract_journal(data)
-    year = extract_year(data)
-    vol = data.get("volume", "")
-    issue = data.get("issue", "")
-    pages = data.get("page", "")
-    doi = data.get("DOI", "")
+    f = fields or extract_fields(data)
+    authors = format_authors(f.authors, "vancouver")
+    title = f.title.rstrip(".")
+    journal, year, vol, issue, pages, doi = f.journal, f.year, f.volume, f.issue, f.pages, f.doi
 
     parts = []
     if authors:
@@ -118,16 +409,13 @@ def format_vancouver(data):
     return " ".join(parts)
 
 
-def format_apa(data):
+def format_apa(data, fields=None):
     """Format reference in APA 7th style."""
-    authors = format_authors(data.get("author", []), "apa")
-    title = data.get("title", [""])[0]
-    journal = extract_journal(data)
-    year = extract_year(data)
-    vol = data.get("volume", "")
-    issue = data.get("issue", "")
-    pages = data.get("page", "")
-    doi = data.get("DOI", "")
+    f = fields or extract_fields(data)
+    authors = format_authors(f.authors, "apa")
+    title, journal, year, vol, issue, pages, doi = (
+        f.title, f.journal, f.year, f.volume, f.issue, f.pages, f.doi
+    )
 
     ref = f"{authors} ({year}). {title}."
     if journal:
@@ -145,14 +433,11 @@ def format_apa(data):
     return ref
 
 
-def format_nature(data):
+def format_nature(data, fields=None):
     """Format reference in Nature style."""
-    authors = format_authors(data.get("author", []), "nature")
-    title = data.get("title", [""])[0]
-    journal = extract_journal(data)
-    year = extract_year(data)
-    vol = data.get("volume", "")
-    pages = data.get("page", "")
+    f = fields or extract_fields(data)
+    authors = format_authors(f.authors, "nature")
+    title, journal, year, vol, pages = f.title, f.journal, f.year, f.volume, f.pages
 
     ref = f"{authors} {title}."
     if journal:
@@ -168,24 +453,21 @@ def format_nature(data):
     return ref
 
 
-def format_bibtex_entry(ref_id, data, fallback=""):
+def format_bibtex_entry(ref_id, data, fallback="", fields=None):
     """Generate a BibTeX entry from CrossRef data."""
     if data is None:
         # Generate minimal entry from fallback
         key = f"ref{ref_id}"
         return f"@article{{{key},\n  note = {{{fallback}}}\n}}\n"
 
-    authors_raw = data.get("author", [])
+    f = fields or extract_fields(data)
+    authors_raw = f.authors
     authors = " and ".join(
         [f"{a.get('family', '')}, {a.get('given', '')}" for a in authors_raw]
     )
-    title = data.get("title", [""])[0]
-    journal = extract_journal(data)
-    year = extract_year(data)
-    vol = data.get("volume", "")
-    issue = data.get("issue", "")
-    pages = data.get("page", "")
-    doi = data.get("DOI", "")
+    title, journal, year, vol, issue, pages, doi = (
+        f.title, f.journal, f.year, f.volume, f.issue, f.pages, f.doi
+    )
 
     # Generate citation key: FirstAuthorYear
     first_author = authors_raw[0].get("family", "Unknown") if authors_raw else "Unknown"
@@ -232,66 +514,79 @@ def main():
                         help="Email for CrossRef API polite pool")
     parser.add_argument("--delay", type=float, default=0.3,
                         help="Delay between API requests in seconds")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Maximum number of concurrent CrossRef requests (default: 8)")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                        help=f"Directory for cached CrossRef metadata (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument("--cache-ttl", type=float, default=DEFAULT_CACHE_TTL_DAYS,
+                        help=f"Days before cached metadata is refetched (default: {DEFAULT_CACHE_TTL_DAYS}, "
+                             "0 disables the cache)")
     args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
 
     formatter = FORMATTERS[args.style]
 
-    with open(args.input) as f:
-        refs_input = json.load(f)
+    with open(args.input, "rb") as f:
+        refs_input = json_loads(f.read())
 
     print(f"Fetching {len(refs_input)} references from CrossRef...")
-    results = []
-    bibtex_entries = []
-
-    for ref in refs_input:
-        doi = ref.get("doi")
-        rid = ref["id"]
-        fallback = ref.get("fallback", f"Reference {rid}")
-
-        if doi:
-            print(f"  [{rid}] Fetching {doi}...", end=" ")
-            data = fetch_crossref(doi, args.email)
-            if data:
-                formatted = formatter(data)
-                source = "crossref"
-                print("OK")
+    cache_dir = os.path.expanduser(args.cache_dir) if args.cache_ttl > 0 else None
+    fetched = asyncio.run(fetch_all(refs_input, args.email, args.delay, args.concurrency,
+                                    cache_dir, args.cache_ttl * 86400))
+    crossref_count = 0
+
+    # Write each entry as soon as it is formatted rather than building the
+    # whole output in memory; the bytes match json.dump(..., indent=2)
+    with open(args.output, "w", encoding="utf-8") as out:
+        if args.format == "bibtex":
+            out.write("% Auto-generated BibTeX file\n")
+            out.write(f"% {len(refs_input)} references\n\n")
+        else:
+            out.write("[")
+
+        for i, (ref, data) in enumerate(zip(refs_input, fetched)):
+            doi = ref.get("doi")
+            rid = ref["id"]
+            fallback = ref.get("fallback", f"Reference {rid}")
+            fields = None
+
+            if doi:
+                print(f"  [{rid}] {doi}...", end=" ")
+                # Extract once and share between the text formatter and BibTeX
+                fields = extract_fields(data) if data else None
+                if data:
+                    formatted = formatter(data, fields)
+                    source = "crossref"
+                    crossref_count += 1
+                    print("OK")
+                else:
+                    formatted = fallback
+                    source = "fallback"
+                    print("FALLBACK")
             else:
                 formatted = fallback
                 source = "fallback"
-                print("FALLBACK")
+                data = None
+                print(f"  [{rid}] No DOI, using fallback")
 
             if args.format == "bibtex":
-                bibtex_entries.append(format_bibtex_entry(rid, data, fallback))
-
-            time.sleep(args.delay)
-        else:
-            formatted = fallback
-            source = "fallback"
-            data = None
-            print(f"  [{rid}] No DOI, using fallback")
-
-            if args.format == "bibtex":
-                bibtex_entries.append(format_bibtex_entry(rid, None, fallback))
-
-        results.append({
-            "id": rid,
-            "doi": doi,
-            "formatted": formatted,
-            "source": source,
-        })
-
-    # Write output
-    if args.format == "json":
-        with open(args.output, "w") as f:
-            json.dump(results, f, indent=2, ensure_ascii=False)
-    elif args.format == "bibtex":
-        with open(args.output, "w") as f:
-            f.write("% Auto-generated BibTeX file\n")
-            f.write(f"% {len(bibtex_entries)} references\n\n")
-            f.write("\n".join(bibtex_entries))
-
-    crossref_count = sum(1 for r in results if r["source"] == "crossref")
-    print(f"\nDone! {crossref_count}/{len(results)} fetched from CrossRef")
+                if i:
+                    out.write("\n")
+                out.write(format_bibtex_entry(rid, data, fallback, fields))
+            else:
+                entry = json_dumps({
+                    "id": rid,
+                    "doi": doi,
+                    "formatted": formatted,
+                    "source": source,
+                }, indent=True)
+                out.write(("," if i else "") + "\n" + textwrap.indent(entry, "  "))
+
+        if args.format == "json":
+            out.write("\n]" if refs_input else "]")
+
+    print(f"\nDone! {crossref_count}/{len(refs_input)} fetched from CrossRef")
     print(f"Output: {args.output}")
 
 
@@ -19,60 +19,72 @@ Prerequisites:
 
 import argparse
 import copy
+import itertools
 import json
 import os
-import random
 import re
-import string
-import xml.etree.ElementTree as ET
+import shutil
+import tempfile
+from lxml import etree as ET
+from xml.sax.saxutils import quoteattr
 
 WML = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+WML_P = f"{{{WML}}}p"
+WML_R = f"{{{WML}}}r"
+WML_T = f"{{{WML}}}t"
+WML_RPR = f"{{{WML}}}rPr"
+WML_BODY = f"{{{WML}}}body"
+XML_NS = "http://www.w3.org/XML/1998/namespace"
 
-# Register all common OOXML namespaces to prevent loss during parsing
-NAMESPACES = {
-    "w": WML,
-    "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
-    "wp": "http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing",
-    "a": "http://schemas.openxmlformats.org/drawingml/2006/main",
-    "mc": "http://schemas.openxmlformats.org/markup-compatibility/2006",
-    "w14": "http://schemas.microsoft.com/office/word/2010/wordml",
-    "w15": "http://schemas.microsoft.com/office/word/2012/wordml",
-    "wp14": "http://schemas.microsoft.com/office/word/2010/wordprocessingDrawing",
-    "wps": "http://schemas.microsoft.com/office/word/2010/wordprocessingShape",
-}
+# Namespace map for elements we create; lxml reuses the document's own
+# declarations once they are attached, so no registration step is needed
+NSMAP = {"w": WML}
 
-for prefix, uri in NAMESPACES.items():
-    ET.register_namespace(prefix, uri)
+CSL_SCHEMA = "https://github.com/citation-style-language/schema/raw/master/csl-citation.json"
+CSL_PREFIX = (
+    '{"citationID": "%s", "properties": {"formattedCitation": %s, "plainCitation": %s, '
+    '"noteIndex": 0}, "citationItems": ['
+)
+CSL_SUFFIX = '], "schema": "' + CSL_SCHEMA + '"}'
+CSL_BIBL_JSON = json.dumps({
+    "uncited": [], "omitted": [], "custom": [], "schema": CSL_SCHEMA,
+}, ensure_ascii=True)
+CSL_ITEM_TEMPLATE = (
+    '{"id": %d, "uris": ["http://zotero.org/users/local/gen/items/REF%04d"], '
+    '"uri": ["http://zotero.org/users/local/gen/items/REF%04d"], '
+    '"itemData": {"id": %d, "type": "article-journal"}}'
+)
 
+# citationID only has to be unique within the document; the pid suffix keeps
+# IDs distinct if several runs ever write into the same file
+CITATION_COUNTER = itertools.count()
 
-def random_id(length=8):
-    return "".join(random.choices(string.ascii_letters + string.digits, k=length))
+# Output held back after a bibliography candidate spills to disk past this size
+HOLD_SPOOL_BYTES = 1 << 20
+
+# Inline numbered citation: [N] or [N, N, ...]
+CITE_RE = re.compile(r"\[(\d+(?:,\s*\d+)*)\]")
+
+# Numbered reference entry ("1. Author ...") at the start of a text run
+BIB_RE = re.compile(r"^\d+\.\s")
+
+XMLNS_ATTR_RE = re.compile(rb'\s+xmlns(?::([\w.-]+))?="([^"]*)"')
+
+
+def next_citation_id():
+    return f"cite{next(CITATION_COUNTER):08x}{os.getpid():04x}"
 
 
 def make_csl_json(ref_ids, display_text, ref_lookup):
     """Build CSL_CITATION JSON payload matching Zotero's format."""
-    items = []
-    for rid in ref_ids:
-        items.append({
-            "id": rid,
-            "uris": [f"http://zotero.org/users/local/gen/items/REF{rid:04d}"],
-            "uri": [f"http://zotero.org/users/local/gen/items/REF{rid:04d}"],
-            "itemData": {"id": rid, "type": "article-journal"},
-        })
-    return json.dumps({
-        "citationID": random_id(),
-        "properties": {
-            "formattedCitation": display_text,
-            "plainCitation": display_text,
-            "noteIndex": 0,
-        },
-        "citationItems": items,
-        "schema": "https://github.com/citation-style-language/schema/raw/master/csl-citation.json",
-    }, ensure_ascii=True)
+    # The payload shape is fixed, so fill a template instead of encoding a dict
+    display = json.dumps(display_text, ensure_ascii=True)
+    items = ", ".join(CSL_ITEM_TEMPLATE % (rid, rid, rid, rid) for rid in ref_ids)
+    return CSL_PREFIX % (next_citation_id(), display, display) + items + CSL_SUFFIX
 
 
 def make_el(tag, attrib=None, text=None):
-    el = ET.Element(f"{{{WML}}}{tag}", attrib or {})
+    el = ET.Element(f"{{{WML}}}{tag}", attrib or {}, nsmap=NSMAP)
     if text:
         el.text = text
     return el
@@ -93,9 +105,10 @@ def make_instr_run(instr_text):
 
 
 def make_text_run(text, rpr_el=None):
+    """Build a text run; `rpr_el` is attached as-is, so pass a node the caller owns."""
     r = make_el("r")
     if rpr_el is not None:
-        r.append(copy.deepcopy(rpr_el))
+        r.append(rpr_el)
     t = make_el("t")
     if text.startswith(" ") or text.endswith(" "):
         t.set("{http://www.w3.org/XML/1998/namespace}space", "preserve")
@@ -104,6 +117,22 @@ def make_text_run(text, rpr_el=None):
     return r
 
 
+def iter_rpr_copies(rpr_el):
+    """Yield run properties for split fragments: the original first, then copies.
+
+    The run being split is discarded, so its rPr can be moved into the first
+    fragment and only the remaining fragments need a copy. Each fragment needs
+    its own node anyway, so caching serialized rPr per paragraph would only add
+    a tostring() per run without saving a copy.
+    """
+    if rpr_el is None:
+        while True:
+            yield None
+    yield rpr_el
+    while True:
+        yield copy.deepcopy(rpr_el)
+
+
 def build_citation_field(ref_ids, display_text, rpr_el, ref_lookup):
     """Return list of XML elements for a complete Zotero citation field."""
     csl = make_csl_json(ref_ids, display_text, ref_lookup)
@@ -117,113 +146,227 @@ def build_citation_field(ref_ids, display_text, rpr_el, ref_lookup):
     ]
 
 
-def fix_missing_namespaces(doc_path):
-    """Add any missing namespace declarations back to the root element."""
-    content = open(doc_path, "r", encoding="utf-8").read()
+def qualified_name(tag, prefixes):
+    """Turn a Clark-notation tag ({uri}local) into prefix:local."""
+    if tag[0] != "{":
+        return tag
+    uri, local = tag[1:].split("}", 1)
+    prefix = prefixes.get(uri)
+    return f"{prefix}:{local}" if prefix else local
+
+
+def start_tag(el, prefixes, nsmap=None):
+    """Serialize an element's opening tag, optionally declaring `nsmap` on it."""
+    parts = [qualified_name(el.tag, prefixes)]
+    for prefix, uri in (nsmap or {}).items():
+        parts.append(f"xmlns:{prefix}={quoteattr(uri)}" if prefix else f"xmlns={quoteattr(uri)}")
+    for key, value in el.attrib.items():
+        parts.append(f"{qualified_name(key, prefixes)}={quoteattr(value)}")
+    return f"<{' '.join(parts)}>"
+
+
+def serialize_child(el, root_decls):
+    """Serialize a subtree to UTF-8, dropping namespace declarations already on the root.
+
+    `root_decls` maps prefix bytes (None for the default namespace) to URI bytes,
+    so the declarations are patched directly in the encoded output.
+    """
+    el.tail = None
+    xml = ET.tostring(el, encoding="UTF-8")
+    head_end = xml.index(b">")
+
+    def drop_declared(m):
+        return b"" if root_decls.get(m.group(1)) == m.group(2) else m.group(0)
+
+    return XMLNS_ATTR_RE.sub(drop_declared, xml[:head_end]) + xml[head_end:]
 
-    required = {
-        "w14": 'xmlns:w14="http://schemas.microsoft.com/office/word/2010/wordml"',
-        "w15": 'xmlns:w15="http://schemas.microsoft.com/office/word/2012/wordml"',
-        "wp14": 'xmlns:wp14="http://schemas.microsoft.com/office/word/2010/wordprocessingDrawing"',
-    }
 
-    m = re.search(r"(<\w+:document\b)", content)
-    if not m:
-        return
+def is_bibliography_para(para):
+    """True if a paragraph starts a numbered reference entry ("1. ...")."""
+    for run in para.findall(WML_R):
+        t = run.find(WML_T)
+        if t is not None and t.text and t.text[:1].isdigit() and BIB_RE.match(t.text):
+            return True
+    return False
 
-    missing = [decl for ns, decl in required.items() if f"xmlns:{ns}=" not in content]
-    if missing:
-        insert = " " + " ".join(missing)
-        pos = m.end()
-        content = content[:pos] + insert + content[pos:]
-        open(doc_path, "w", encoding="utf-8").write(content)
-        print(f"  Fixed {len(missing)} missing namespace declarations")
 
+def is_empty_para(para):
+    """True for a paragraph with no text at all, e.g. a blank line between references."""
+    return para.tag == WML_P and not any(t.text for t in para.iter(WML_T))
 
-def inject_inline_citations(body, ref_lookup):
-    """Find [N] patterns in text runs and wrap them in Zotero field codes."""
-    cite_pattern = re.compile(r"\[(\d+(?:,\s*\d+)*)\]")
+
+def inject_inline_citations(el, ref_lookup):
+    """Find [N] patterns in text runs under `el` and wrap them in Zotero field codes."""
     count = 0
 
-    for para in body.iter(f"{{{WML}}}p"):
-        runs = list(para.findall(f"{{{WML}}}r"))
+    for para in el.iter(WML_P):
+        # Rebuild the child list in one pass instead of index()/insert() per run
+        children = list(para)
+        new_children = []
+        changed = False
 
-        for run in runs:
-            t_el = run.find(f"{{{WML}}}t")
+        for child in children:
+            t_el = child.find(WML_T) if child.tag == WML_R else None
             if t_el is None or t_el.text is None:
+                new_children.append(child)
                 continue
 
             text = t_el.text
-            matches = list(cite_pattern.finditer(text))
-            if not matches:
+            # Cheap prefilter: most runs have no bracket, skip the regex entirely
+            first = CITE_RE.search(text) if "[" in text else None
+            if first is None:
+                new_children.append(child)
                 continue
 
-            rpr = run.find(f"{{{WML}}}rPr")
-            run_idx = list(para).index(run)
-            para.remove(run)
+            matches = list(CITE_RE.finditer(text, first.start()))
 
-            insert_pos = run_idx
+            changed = True
+            rprs = iter_rpr_copies(child.find(WML_RPR))
             last_end = 0
 
             for m in matches:
                 before = text[last_end:m.start()]
                 if before:
-                    para.insert(insert_pos, make_text_run(before, rpr))
-                    insert_pos += 1
+                    new_children.append(make_text_run(before, next(rprs)))
 
                 cite_text = m.group(0)
                 ref_ids = [int(x.strip()) for x in m.group(1).split(",")]
-
-                for el in build_citation_field(ref_ids, cite_text, rpr, ref_lookup):
-                    para.insert(insert_pos, el)
-                    insert_pos += 1
+                new_children.extend(build_citation_field(ref_ids, cite_text, next(rprs), ref_lookup))
 
                 count += 1
                 last_end = m.end()
 
             after = text[last_end:]
             if after:
-                para.insert(insert_pos, make_text_run(after, rpr))
-
-    return count
+                new_children.append(make_text_run(after, next(rprs)))
 
+        if changed:
+            # Slice assignment keeps the paragraph's attributes, unlike clear()
+            para[:] = new_children
 
-def inject_bibliography_field(body):
-    """Wrap bibliography paragraphs in a ZOTERO_BIBL field code."""
-    ref_paras = []
-    for para in body.findall(f"{{{WML}}}p"):
-        for run in para.findall(f"{{{WML}}}r"):
-            t = run.find(f"{{{WML}}}t")
-            if t is not None and t.text and re.match(r"^\d+\.\s", t.text):
-                ref_paras.append(para)
-                break
-
-    if not ref_paras:
-        print("  No bibliography paragraphs found")
-        return 0
+    return count
 
-    first_ref = ref_paras[0]
-    last_ref = ref_paras[-1]
-    first_idx = list(body).index(first_ref)
 
-    # Insert field begin paragraph before first reference
+def make_bibliography_begin():
+    """Paragraph opening the ZOTERO_BIBL field, placed before the first reference."""
     begin_para = make_el("p")
     begin_para.append(make_fldchar("begin"))
-    bib_json = json.dumps({
-        "uncited": [], "omitted": [], "custom": [],
-        "schema": "https://github.com/citation-style-language/schema/raw/master/csl-citation.json",
-    }, ensure_ascii=True)
-    begin_para.append(make_instr_run(f"ADDIN ZOTERO_BIBL {bib_json} CSL_BIBLIOGRAPHY"))
+    begin_para.append(make_instr_run(f"ADDIN ZOTERO_BIBL {CSL_BIBL_JSON} CSL_BIBLIOGRAPHY"))
     begin_para.append(make_fldchar("separate"))
-    body.insert(first_idx, begin_para)
+    return begin_para
+
 
-    # Insert field end paragraph after last reference (+1 because we just inserted)
+def make_bibliography_end():
+    """Paragraph closing the ZOTERO_BIBL field, placed after the last reference."""
     end_para = make_el("p")
     end_para.append(make_fldchar("end"))
-    new_last_idx = list(body).index(last_ref)
-    body.insert(new_last_idx + 1, end_para)
+    return end_para
+
+
+def inject_all(doc_path, out, ref_lookup):
+    """Copy document.xml to the binary stream `out`, injecting all field codes in one pass.
+
+    Each direct child of ``w:body`` is checked for a bibliography entry, gets
+    its inline citations wrapped, and is serialized as soon as its end tag is
+    parsed, then dropped from the tree. The bibliography is the last contiguous
+    block of numbered reference paragraphs, where empty paragraphs neither end
+    nor start a block. Since a later block may still replace it, the current
+    block cannot be written until the body ends or another block starts.
+
+    The block itself (plus any blank paragraphs after its last entry) is kept
+    in memory. Everything after the block is also held back, because the
+    field's end marker must precede it. That tail goes to a spooled temporary
+    file that moves to disk past HOLD_SPOOL_BYTES. This matters when an early
+    numbered paragraph such as a typed "1. Introduction" heading is taken as a
+    candidate: the rest of the document is buffered, on disk rather than in
+    memory, until ``</w:body>``. Returns ``(cite_count, bib_count)``, or None
+    if the document has no body.
+    """
+    nsmap = {}
+    prefixes = {XML_NS: "xml"}
+    root_decls = {}
+    stack = []
+    body = None
+    cite_count = 0
+
+    # Current bibliography candidate: its chunks, blank paragraphs after its
+    # latest entry, and the spooled output once a non-blank child ended it
+    block = None
+    gap = []
+    tail = None
+    bib_count = 0
+
+    def write_held(wrap):
+        if wrap:
+            out.write(serialize_child(make_bibliography_begin(), root_decls))
+        out.write(b"".join(block))
+        if wrap:
+            out.write(serialize_child(make_bibliography_end(), root_decls))
+        out.write(b"".join(gap))
+        if tail is not None:
+            tail.seek(0)
+            shutil.copyfileobj(tail, out)
+            tail.close()
+
+    out.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n')
+
+    for event, el in ET.iterparse(doc_path, events=("start", "end")):
+        if event == "start":
+            stack.append(el)
+            if len(stack) == 1:
+                # lxml keeps the root's original declarations, used or not
+                nsmap = dict(el.nsmap)
+                prefixes.update({uri: prefix for prefix, uri in nsmap.items()})
+                root_decls = {(prefix.encode("utf-8") if prefix else None): uri.encode("utf-8")
+                              for prefix, uri in nsmap.items()}
+                out.write(start_tag(el, prefixes, nsmap).encode("utf-8"))
+            elif len(stack) == 2 and el.tag == WML_BODY:
+                body = el
+                out.write(start_tag(el, prefixes).encode("utf-8"))
+            continue
+
+        stack.pop()
+        if len(stack) == 2 and stack[-1] is body:
+            is_bib = el.tag == WML_P and is_bibliography_para(el)
+            cite_count += inject_inline_citations(el, ref_lookup)
+            chunk = serialize_child(el, root_decls)
+            in_block = block is not None and tail is None
+
+            if is_bib and in_block:
+                block.extend(gap)
+                block.append(chunk)
+                gap = []
+                bib_count += 1
+            elif is_bib:
+                # A new block supersedes the held one, which goes out unwrapped
+                if block is not None:
+                    write_held(wrap=False)
+                block, gap, tail = [chunk], [], None
+                bib_count = 1
+            elif block is None:
+                out.write(chunk)
+            elif in_block and is_empty_para(el):
+                gap.append(chunk)
+            else:
+                if tail is None:
+                    tail = tempfile.SpooledTemporaryFile(max_size=HOLD_SPOOL_BYTES)
+                    tail.write(b"".join(gap))
+                    gap = []
+                tail.write(chunk)
+
+            body.remove(el)
+        elif len(stack) == 1 and el is not body:
+            # Other children of the root (e.g. w:background) pass through untouched
+            out.write(serialize_child(el, root_decls))
+            stack[0].remove(el)
+        elif len(stack) <= 1:
+            if el is body and block is not None:
+                write_held(wrap=True)
+            out.write(f"</{qualified_name(el.tag, prefixes)}>".encode("utf-8"))
 
-    return len(ref_paras)
+    if body is None:
+        return None
+    return cite_count, bib_count
 
 
 def main():
@@ -238,28 +381,28 @@ def main():
     refs = json.load(open(args.refs))
     ref_lookup = {r["id"]: r for r in refs}
 
-    # Parse XML
-    tree = ET.parse(doc_path)
-    root = tree.getroot()
-    body = root.find(f"{{{WML}}}body")
-
-    if body is None:
+    # Stream the rewritten document next to the original, then swap
+    tmp_path = doc_path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as out:
+            counts = inject_all(doc_path, out, ref_lookup)
+        if counts is not None:
+            os.replace(tmp_path, doc_path)
+    finally:
+        # Never leave the partial file in unpacked/ where pack.py would zip it
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    if counts is None:
         print("Error: No <w:body> found in document.xml")
         return 1
 
-    # Inject inline citations
-    cite_count = inject_inline_citations(body, ref_lookup)
+    cite_count, bib_count = counts
     print(f"Injected {cite_count} inline Zotero citation field codes")
-
-    # Inject bibliography field
-    bib_count = inject_bibliography_field(body)
-    print(f"Wrapped {bib_count} bibliography entries in ZOTERO_BIBL field")
-
-    # Write back
-    tree.write(doc_path, xml_declaration=True, encoding="UTF-8")
-
-    # Fix namespace declarations that ElementTree may have dropped
-    fix_missing_namespaces(doc_path)
+    if bib_count:
+        print(f"Wrapped {bib_count} bibliography entries in ZOTERO_BIBL field")
+    else:
+        print("  No bibliography paragraphs found")
 
     print("Done! Zotero field codes injected successfully.")
     return 0